@@ -1,11 +1,16 @@
 import json
 import logging
 import requests
+import urllib3
 import uuid
 import threading
 import time
 import os
 import base64
+import hashlib
+import contextlib
+import itertools
+import collections
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from plugins import Plugin, Event, EventAction, EventContext, register
@@ -13,8 +18,759 @@ from common.log import logger
 from datetime import datetime, timedelta
 from urllib.parse import urlparse
 import random
-from PIL import Image
 import io
+import socket
+import re
+
+class _SingleFlight:
+    """合并参数相同的并发任务，同一时刻只向上游发起一次请求"""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+            # 发起者因自身原因放弃时置位，等待者重新竞争执行
+            self.handoff = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def running(self, key):
+        """是否已有相同key的任务在执行"""
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, fn, on_join=None, check=None, personal=()):
+        """执行fn并返回结果；若已有相同key的任务在执行，则等待并共享其结果
+
+        check在等待期间每秒调用一次，抛出异常即放弃等待。发起者抛出personal中的
+        异常（如本人取消）时不共享给等待者，由等待者之一用自己的fn重新执行。
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = self._Call()
+                else:
+                    call.waiters += 1
+
+            if leader:
+                break
+
+            logger.info(f"[ZPHH] 合并到进行中的相同任务: {key[0]}")
+            if on_join:
+                on_join()
+            try:
+                while not call.done.wait(1):
+                    if check:
+                        check()
+            except BaseException:
+                # 提前离开的等待者不再计数，发起者据此判断是否还有人需要结果
+                with self._lock:
+                    call.waiters -= 1
+                raise
+            if call.handoff:
+                logger.info(f"[ZPHH] 相同任务的发起者已放弃，重新执行: {key[0]}")
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        error = None
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # 出队和决定是否共享异常在同一把锁内完成，之后不会再有新的等待者
+            with self._lock:
+                self._calls.pop(key, None)
+                if error is not None:
+                    if isinstance(error, personal) and call.waiters:
+                        call.handoff = True
+                    else:
+                        call.error = error
+            call.done.set()
+            if call.waiters and not call.handoff:
+                logger.info(f"[ZPHH] 任务结果已共享给{call.waiters}个相同请求: {key[0]}")
+
+
+class _Aborted(Exception):
+    """任务被用户取消或超过了截止时间，异常信息即回复给用户的提示"""
+
+
+class _Cancelled(_Aborted):
+    """任务被发起者本人取消，只影响该用户，不共享给合并进来的其他请求"""
+
+
+# 各类任务默认的总时间预算（秒）
+_DEFAULT_DEADLINES = {"draw": 180, "video": 900, "video_ref": 900, "draw_video": 1080}
+
+# 各阶段可使用的时间占任务总预算的比例，未列出的阶段（如轮询）可用到任务截止
+_STAGE_SHARES = {"fetch": 0.1, "upload": 0.15, "create": 0.1}
+
+
+class _Job:
+    """一次用户请求对应的任务，任务ID贯穿下载、上传、创建、轮询和发送各阶段"""
+
+    def __init__(self, kind, user_id="", group_id="", budget=0):
+        self.id = uuid.uuid4().hex[:24]
+        self.kind = kind
+        self.user_id = user_id
+        self.group_id = group_id
+        self.created = time.time()
+        self.budget = budget
+        self.deadline = self.created + budget if budget else float("inf")
+        self.stage_deadline = None
+        # 任务占用的调度通道名额，合并到他人任务或结束时释放
+        self.lane = None
+        self.cancelled = threading.Event()
+        self.abort_reason = ""
+        self.cancelled_by_user = False
+        self._streams = []
+        self._lock = threading.Lock()
+        self._watchdog = None
+        self._seq = itertools.count(1)
+
+    def next_request_id(self):
+        """生成本任务下的X-Request-Id，前24位为任务ID，后8位为请求序号"""
+        return f"{self.id}{next(self._seq):08x}"
+
+    def start_watchdog(self):
+        """到达截止时间时自动中止任务，关闭仍在读取的流"""
+        if self.budget:
+            self._watchdog = threading.Timer(self.budget, self.cancel, args=("任务超时，已自动取消", False))
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+    def stop_watchdog(self):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+
+    def cancel(self, reason="任务已取消", by_user=True):
+        """中止任务：等待中的轮询和排队立即返回，打开的流被关闭"""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self.abort_reason = reason
+                self.cancelled_by_user = by_user
+                self.cancelled.set()
+            streams, self._streams = self._streams, []
+        for response in streams:
+            self._close_stream(response)
+
+    def track(self, response):
+        """登记正在读取的流式响应，取消任务时一并关闭"""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._streams.append(response)
+                return
+        self._close_stream(response)
+
+    @staticmethod
+    def _close_stream(response):
+        """关闭流式响应；其他线程阻塞在recv上时，只有shutdown套接字才能立即唤醒它"""
+        try:
+            sock = response.raw._connection.sock
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            response.close()
+        except Exception:
+            pass
+
+    def enter_stage(self, stage):
+        """进入一个有独立预算的阶段，返回之前的阶段截止时间以便恢复"""
+        previous = self.stage_deadline
+        if self.budget and stage in _STAGE_SHARES:
+            self.stage_deadline = time.time() + self.budget * _STAGE_SHARES[stage]
+        return previous
+
+    def remaining(self):
+        """当前阶段剩余的秒数"""
+        deadline = self.deadline if self.stage_deadline is None else min(self.deadline, self.stage_deadline)
+        return deadline - time.time()
+
+    def check(self):
+        """任务已取消或超时时抛出_Aborted"""
+        if self.cancelled.is_set():
+            raise (_Cancelled if self.cancelled_by_user else _Aborted)(self.abort_reason)
+        if self.remaining() <= 0:
+            raise _Aborted("任务超时，已自动取消" if time.time() >= self.deadline else "任务某个阶段耗时过长，已自动取消")
+
+
+class _Rejected(Exception):
+    """任务被调度通道拒绝，异常信息即回复给用户的提示"""
+
+
+class _FairLane:
+    """按用户和群公平分配并发名额的调度通道，并限制每个用户在滚动窗口内的次数"""
+
+    def __init__(self, name, capacity=2, per_user=1, max_queued_per_user=2, quota=0, window=3600, max_wait=300):
+        self.name = name
+        self.capacity = capacity
+        self.per_user = per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.quota = quota
+        self.window = window
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._running = 0
+        self._user_running = collections.Counter()
+        self._group_running = collections.Counter()
+        self._waiting = []
+        self._history = collections.defaultdict(collections.deque)
+        self._seq = itertools.count()
+
+    def acquire(self, user_id, group_id, on_queued=None, cancelled=None, deadline=None):
+        """申请一个名额，成功返回None，被拒绝时返回给用户的提示
+
+        排队期间cancelled被设置或到达deadline时放弃排队。
+        """
+        # 私聊没有群，按用户自己单独计，避免所有私聊用户被当成同一个群
+        group_id = group_id or user_id
+        with self._cond:
+            now = time.time()
+            history = self._history[user_id]
+            while history and history[0] <= now - self.window:
+                history.popleft()
+            user_waiting = sum(1 for ticket in self._waiting if ticket[0] == user_id)
+            if self.quota and len(history) + user_waiting >= self.quota:
+                minutes = max(1, int((history[0] + self.window - now) // 60)) if history else self.window // 60
+                return f"您的{self.name}任务已达到{self.window // 60}分钟内{self.quota}次的上限，请{minutes}分钟后再试"
+            # 名额被其他用户占满时同样需要排队，排队数量不论是否已有任务运行都要限制
+            must_wait = user_waiting or self._running >= self.capacity or self._user_running[user_id] >= self.per_user
+            if must_wait and user_waiting >= self.max_queued_per_user:
+                return f"您已有{self._user_running[user_id] + user_waiting}个{self.name}任务在进行或排队中，请等待完成后再试"
+
+            ticket = (user_id, group_id, next(self._seq))
+            self._waiting.append(ticket)
+            deadline = min(now + self.max_wait, deadline or float("inf"))
+            notified = False
+            while self._pick() is not ticket:
+                remaining = deadline - time.time()
+                if remaining <= 0 or (cancelled is not None and cancelled.is_set()):
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+                    if cancelled is not None and cancelled.is_set():
+                        return "任务已取消"
+                    return f"当前{self.name}任务排队较多，请稍后再试"
+                if not notified and on_queued:
+                    notified = True
+                    position = len(self._waiting) - 1
+                    # 通知可能较慢，先释放锁再回调
+                    self._cond.release()
+                    try:
+                        on_queued(position)
+                    finally:
+                        self._cond.acquire()
+                    continue
+                # 分段等待，以便及时响应取消
+                self._cond.wait(min(remaining, 1))
+
+            self._waiting.remove(ticket)
+            self._running += 1
+            self._user_running[user_id] += 1
+            self._group_running[group_id] += 1
+            history.append(time.time())
+            self._cond.notify_all()
+            return None
+
+    def release(self, user_id, group_id, refund=False):
+        """归还名额，refund为True时同时退还本次计入的配额"""
+        group_id = group_id or user_id
+        with self._cond:
+            self._running -= 1
+            self._user_running[user_id] -= 1
+            if self._user_running[user_id] <= 0:
+                del self._user_running[user_id]
+            self._group_running[group_id] -= 1
+            if self._group_running[group_id] <= 0:
+                del self._group_running[group_id]
+            if refund and self._history[user_id]:
+                self._history[user_id].pop()
+            self._cond.notify_all()
+
+    def _pick(self):
+        """选出下一个可以运行的排队请求：优先当前占用名额少、近期用量少的用户和群，其次先到先得"""
+        if self._running >= self.capacity:
+            return None
+        eligible = [t for t in self._waiting if self._user_running[t[0]] < self.per_user]
+        if not eligible:
+            return None
+        return min(eligible, key=lambda t: (
+            self._user_running[t[0]],
+            self._group_running[t[1]],
+            len(self._history[t[0]]),
+            t[2],
+        ))
+
+
+# 每种任务所属的调度通道，绘图为快通道，视频为慢通道
+_JOB_LANES = {"draw": "draw", "video": "video", "video_ref": "video", "draw_video": "video"}
+
+
+class _MultipartStream:
+    """边下载边发送的multipart请求体
+
+    总长度预先算好，requests会带上Content-Length并逐块发送，
+    不需要把整张图片读入内存或写入临时文件。
+    """
+
+    def __init__(self, fields, file_name, file_type, file_size, file_chunks):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._preamble = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+            f"Content-Type: {file_type}\r\n\r\n"
+        ).encode()
+        self._epilogue = b"\r\n" + b"".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items()
+        ) + f"--{boundary}--\r\n".encode()
+        self._file_size = file_size
+        self._file_chunks = file_chunks
+        self.len = len(self._preamble) + file_size + len(self._epilogue)
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        yield self._preamble
+        sent = 0
+        for chunk in self._file_chunks:
+            sent += len(chunk)
+            yield chunk
+        if sent != self._file_size:
+            raise IOError(f"图片大小与Content-Length不一致: {sent} != {self._file_size}")
+        yield self._epilogue
+
+
+def _endpoint_class(method, url):
+    """按接口的延迟特征归类，同一类接口共用学习到的超时"""
+    parsed = urlparse(url)
+    if parsed.netloc != "chatglm.cn":
+        return "fetch"
+    if parsed.path.endswith("/static/upload"):
+        return "upload"
+    if "/chat/status/" in parsed.path:
+        return "poll"
+    if parsed.path.endswith("/assistant/stream"):
+        return "stream"
+    if parsed.path.endswith("/user/refresh"):
+        return "auth"
+    return "create" if method.upper() == "POST" else "default"
+
+
+class _AdaptiveTimeouts:
+    """根据最近观测到的延迟推算各类接口的连接超时和读取超时
+
+    读取超时取该类接口首字节耗时的分位数乘以倍数，连接超时取新建连接（含TLS握手）
+    耗时的分位数乘以倍数，都限制在配置的上下限之间；样本不足时使用上限。
+    """
+
+    def __init__(self, classes, percentile=95, multiplier=3, min_samples=10, window=200):
+        self._classes = classes
+        self._percentile = percentile
+        self._multiplier = multiplier
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+        self._read = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self._connect = collections.deque(maxlen=window)
+
+    def record_read(self, endpoint_class, seconds):
+        with self._lock:
+            self._read[endpoint_class].append(seconds)
+
+    def record_connect(self, seconds):
+        with self._lock:
+            self._connect.append(seconds)
+
+    def get(self, endpoint_class):
+        """返回(连接超时, 读取超时)"""
+        bounds = self._classes.get(endpoint_class) or self._classes["default"]
+        with self._lock:
+            connect = self._estimate(self._connect, bounds["connect_floor"], bounds["connect_ceiling"])
+            read = self._estimate(self._read[endpoint_class], bounds["read_floor"], bounds["read_ceiling"])
+        return connect, read
+
+    def _estimate(self, samples, floor, ceiling):
+        if len(samples) < self._min_samples:
+            return ceiling
+        ordered = sorted(samples)
+        value = ordered[min(len(ordered) - 1, int(len(ordered) * self._percentile / 100))]
+        return min(max(value * self._multiplier, floor), ceiling)
+
+
+class _TimedAdapter(requests.adapters.HTTPAdapter):
+    """记录新建HTTPS连接耗时的适配器，复用连接池中的连接不计入"""
+
+    def __init__(self, on_connect, **kwargs):
+        self._on_connect = on_connect
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        on_connect = self._on_connect
+
+        class TimedConnection(urllib3.connection.HTTPSConnection):
+            def connect(self):
+                start_time = time.monotonic()
+                super().connect()
+                on_connect(time.monotonic() - start_time)
+
+        class TimedPool(urllib3.HTTPSConnectionPool):
+            ConnectionCls = TimedConnection
+
+        self.poolmanager.pool_classes_by_scheme = {**self.poolmanager.pool_classes_by_scheme, "https": TimedPool}
+
+
+class _PrefetchedImage:
+    """收到图片后在后台预先读取并上传的结果，参考图命令到来时直接使用"""
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+        self.created = time.time()
+        self.done = threading.Event()
+        # 上传成功后只保留摘要和source_id，失败时保留图片数据供命令重新上传
+        self.image_data = None
+        self.digest = None
+        self.source_id = None
+
+    def expired(self, ttl):
+        return time.time() - self.created > ttl
+
+
+class _SharedState:
+    """同一主机上多个进程共享的access_token和视频任务登记表，基于本地SQLite文件"""
+
+    def __init__(self, path):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self._path = path
+        self._local = threading.local()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._secure_file(path)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, updated REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS video_jobs ("
+            "chat_id TEXT PRIMARY KEY, owner TEXT, status TEXT, video_url TEXT, msg TEXT, created REAL, updated REAL)"
+        )
+
+    @staticmethod
+    def _secure_file(path):
+        """文件中保存着access_token：只允许当前用户读写，拒绝使用他人创建的文件"""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        try:
+            st = os.fstat(fd)
+            if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+                raise PermissionError(f"共享状态文件属于其他用户: {path}")
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+
+    def _conn(self):
+        # sqlite连接不能跨线程使用，每个线程各自持有一个
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def get_token(self):
+        """返回(token, 更新时间)，没有时返回("", 0)"""
+        row = self._conn().execute("SELECT value, updated FROM kv WHERE key = 'access_token'").fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    def set_token(self, token):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO kv (key, value, updated) VALUES ('access_token', ?, ?)",
+            (token, time.time())
+        )
+
+    def try_lease(self, name, ttl):
+        """尝试获取或续期一个带过期时间的锁，进程退出后锁会自然过期"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != self.owner and row[1] > now:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)",
+                (name, self.owner, now + ttl)
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release_lease(self, name):
+        self._conn().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+
+    def register_video(self, chat_id):
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR IGNORE INTO video_jobs (chat_id, owner, status, created, updated) VALUES (?, ?, 'pending', ?, ?)",
+            (chat_id, self.owner, now, now)
+        )
+
+    def pending_videos(self, max_age):
+        """返回仍在生成中的视频任务，超过max_age的任务标记为超时"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute(
+            "UPDATE video_jobs SET status = 'timeout', updated = ? WHERE status = 'pending' AND created < ?",
+            (now, now - max_age)
+        )
+        # 清理一天前已结束的任务
+        conn.execute("DELETE FROM video_jobs WHERE status != 'pending' AND updated < ?", (now - 86400,))
+        return [row[0] for row in conn.execute("SELECT chat_id FROM video_jobs WHERE status = 'pending' ORDER BY created")]
+
+    def finish_video(self, chat_id, status, video_url=None, msg=None):
+        self._conn().execute(
+            "UPDATE video_jobs SET status = ?, video_url = ?, msg = ?, updated = ? WHERE chat_id = ?",
+            (status, video_url, msg, time.time(), chat_id)
+        )
+
+    def get_video(self, chat_id):
+        """返回(状态, 视频URL, 消息)"""
+        row = self._conn().execute("SELECT status, video_url, msg FROM video_jobs WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row if row else (None, None, None)
+
+
+class _TraceLog:
+    """按文件大小滚动的JSONL日志，用于任务追踪和流量录制"""
+
+    def __init__(self, path, max_bytes, backup_count):
+        from logging.handlers import RotatingFileHandler
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._logger = logging.getLogger(f"zphh.trace.{path}")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        if not self._logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+
+    def write(self, record):
+        self._logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+class _RecordingSession(requests.Session):
+    """录制所有请求和响应的会话，敏感信息脱敏后写入JSONL，流式响应按分片记录到达时间"""
+
+    _SENSITIVE_HEADERS = {"authorization", "cookie", "set-cookie", "x-device-id"}
+    _TOKEN_PATTERN = re.compile(r'("(?:access_token|refresh_token)"\s*:\s*")[^"]*(")')
+
+    def __init__(self, log, max_body_bytes):
+        super().__init__()
+        self._log = log
+        self._max_body_bytes = max_body_bytes
+
+    def request(self, method, url, **kwargs):
+        start_time = time.time()
+        response = super().request(method, url, **kwargs)
+        try:
+            exchange = {
+                "ts": round(start_time, 3),
+                "method": method.upper(),
+                "url": url.split("?")[0],
+                "request": self._describe_request(kwargs),
+                "status": response.status_code,
+                "headers": self._sanitize_headers(response.headers),
+                "elapsed_ms": round((time.time() - start_time) * 1000, 1),
+            }
+            if kwargs.get("stream"):
+                self._wrap_stream(response, exchange, time.time())
+            else:
+                exchange["body"] = self._encode(response.content)
+                self._log.write(exchange)
+        except Exception as e:
+            logger.debug(f"[ZPHH] 录制请求失败: {e}")
+        return response
+
+    def _wrap_stream(self, response, exchange, headers_time):
+        """包装iter_content，在流读取完毕后连同每个分片的到达时间一起写出"""
+        iter_content = response.iter_content
+        log = self._log
+
+        def recording_iter_content(chunk_size=1, decode_unicode=False):
+            chunks = []
+            try:
+                for chunk in iter_content(chunk_size, decode_unicode):
+                    chunks.append({"t": round((time.time() - headers_time) * 1000, 1), **self._encode(chunk)})
+                    yield chunk
+            finally:
+                exchange["chunks"] = chunks
+                log.write(exchange)
+
+        response.iter_content = recording_iter_content
+
+    def _describe_request(self, kwargs):
+        request = {}
+        headers = kwargs.get("headers") or {}
+        if headers.get("X-Request-Id"):
+            request["request_id"] = headers["X-Request-Id"]
+        if kwargs.get("json") is not None:
+            request["json"] = json.loads(self._TOKEN_PATTERN.sub(r"\1***\2", json.dumps(kwargs["json"], ensure_ascii=False)))
+        elif kwargs.get("data") is not None:
+            data = kwargs["data"]
+            request["body_bytes"] = getattr(data, "len", None) or (len(data) if isinstance(data, (bytes, str)) else None)
+        if kwargs.get("params"):
+            request["params"] = kwargs["params"]
+        return request
+
+    def _sanitize_headers(self, headers):
+        return {k: v for k, v in headers.items() if k.lower() not in self._SENSITIVE_HEADERS}
+
+    def _encode(self, data):
+        """文本按原样记录并隐藏token，二进制用base64，超过上限只记录长度"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if len(data) > self._max_body_bytes:
+            return {"omitted": len(data)}
+        try:
+            return {"text": self._TOKEN_PATTERN.sub(r"\1***\2", data.decode("utf-8"))}
+        except UnicodeDecodeError:
+            return {"b64": base64.b64encode(data).decode("ascii")}
+
+
+class _ReplayRaw:
+    """按录制时的分片和间隔回放响应体，并统计调用方处理分片所用的时间"""
+
+    def __init__(self, chunks, speed, on_finish):
+        self._chunks = chunks
+        self._speed = speed
+        self._on_finish = on_finish
+        self._buffer = b""
+        self._iterator = None
+
+    def stream(self, chunk_size=None, decode_content=True):
+        start_time = time.time()
+        slept = 0.0
+        last_offset = 0.0
+        for chunk in self._chunks:
+            delay = (chunk["t"] - last_offset) / 1000 / self._speed if self._speed > 0 else 0
+            last_offset = chunk["t"]
+            if delay > 0:
+                time.sleep(delay)
+                slept += delay
+            yield _ReplaySession.decode(chunk)
+        self._on_finish((time.time() - start_time - slept) * 1000, len(self._chunks))
+
+    def read(self, amt=None, decode_content=True):
+        if self._iterator is None:
+            self._iterator = self.stream()
+        while amt is None or len(self._buffer) < amt:
+            chunk = next(self._iterator, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data, self._buffer = (self._buffer, b"") if amt is None else (self._buffer[:amt], self._buffer[amt:])
+        return data
+
+    def close(self):
+        pass
+
+
+class _ReplaySession:
+    """用录制的流量代替网络，按原速或加速回放，用于离线复现解析和轮询的性能"""
+
+    def __init__(self, path, speed, report):
+        self._speed = speed
+        self._report = report
+        self._lock = threading.Lock()
+        self._recordings = collections.defaultdict(collections.deque)
+        self._last = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    exchange = json.loads(line)
+                    self._recordings[self._key(exchange["method"], exchange["url"])].append(exchange)
+        logger.info(f"[ZPHH] 已加载回放流量: {path}, 共{sum(len(q) for q in self._recordings.values())}条")
+
+    @staticmethod
+    def _key(method, url):
+        parsed = urlparse(url)
+        return method.upper(), parsed.netloc + parsed.path
+
+    @staticmethod
+    def decode(chunk):
+        if "text" in chunk:
+            return chunk["text"].encode("utf-8")
+        if "b64" in chunk:
+            return base64.b64decode(chunk["b64"])
+        return b"\0" * chunk.get("omitted", 0)
+
+    def request(self, method, url, stream=False, **kwargs):
+        key = self._key(method, url)
+        with self._lock:
+            queue = self._recordings.get(key)
+            # 录制用完后重复最后一条，便于轮询类请求继续回放
+            exchange = queue.popleft() if queue else self._last.get(key)
+            if exchange is None:
+                raise requests.exceptions.ConnectionError(f"回放流量中没有该请求: {method} {url}")
+            self._last[key] = exchange
+
+        if self._speed > 0:
+            time.sleep(exchange.get("elapsed_ms", 0) / 1000 / self._speed)
+
+        chunks = exchange.get("chunks")
+        if chunks is None:
+            chunks = [{"t": 0, **{k: v for k, v in exchange.get("body", {}).items()}}]
+
+        def on_finish(processing_ms, chunk_count):
+            self._report(exchange, processing_ms, chunk_count)
+
+        response = requests.models.Response()
+        response.status_code = exchange["status"]
+        response.headers = requests.structures.CaseInsensitiveDict(exchange.get("headers", {}))
+        response.headers.pop("Content-Encoding", None)
+        response.url = url
+        response.elapsed = timedelta(milliseconds=exchange.get("elapsed_ms", 0))
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = _ReplayRaw(chunks, self._speed, on_finish)
+        response.request = requests.Request(method.upper(), url).prepare()
+        if not stream:
+            # 非流式请求与requests一致，返回前读完响应体
+            response.content
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def close(self):
+        pass
+
 
 @register(
     name="ZPHH",
@@ -26,6 +782,8 @@ class ZPHHPlugin(Plugin):
     def __init__(self):
         super().__init__()
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+        # 取消命令在消息进入会话队列之前处理，不必排在正在执行的任务后面
+        self.handlers[Event.ON_RECEIVE_MESSAGE] = self.on_receive_message
        
         self.conversation_id = ""
         self.config = self._load_config()
@@ -43,9 +801,48 @@ class ZPHHPlugin(Plugin):
         self.temp_dir = os.path.join(os.path.dirname(__file__), "tmp")
         os.makedirs(self.temp_dir, exist_ok=True)
         
-        # 初始化时刷新access_token
-        if not self.refresh_access_token():
-            logger.error("[ZPHH] Failed to refresh access token on initialization")
+        # 按需开启的性能分析，剩余次数由管理员命令设置
+        self._profile_lock = threading.Lock()
+        self._profile_remaining = 0
+        self._tracemalloc_users = 0
+        self._tracemalloc_owned = False
+        
+        # 可选的多进程共享状态，需在首次刷新token之前创建
+        self._shared = self._create_shared_state()
+        self._shared_poll_lock = threading.Lock()
+        self._last_shared_poll = 0
+        self._shared_waiters = 0
+        
+        # 当前线程正在处理的任务，以及可选的阶段耗时记录
+        self._local = threading.local()
+        self._trace = self._create_trace_log()
+        
+        # 按接口类别从观测到的延迟学习超时，需在创建会话之前创建
+        self._timeouts = self._create_timeouts()
+        
+        # 复用连接的会话，避免每次请求都重新握手；可切换为录制或回放模式
+        self.session = self._create_session()
+        
+        # 快慢任务分开调度，避免绘图请求排在长时间的视频任务之后
+        self._lanes = self._create_lanes()
+        
+        # 进行中的任务，供取消命令查找
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        
+        # 合并相同参数的进行中任务
+        self._inflight = _SingleFlight()
+        
+        # 按会话和发送者保存最近一张预先上传的图片
+        self._prefetched = {}
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_slots = threading.BoundedSemaphore(max(int(self._prefetch_config().get('max_concurrent', 2)), 1))
+        
+        # access_token就绪事件，首次刷新在后台完成，请求只在需要时等待
+        self._token_ready = threading.Event()
+        
+        # 后台刷新token、预热连接和依赖，不阻塞插件加载
+        self._start_background_init()
         # 启动定时刷新token的线程
         self._start_token_refresh_timer()
         logger.info("[ZPHH] plugin initialized")
@@ -60,10 +857,50 @@ class ZPHHPlugin(Plugin):
         except Exception as e:
             logger.error(f"[ZPHH] Failed to create temp directory: {e}")
 
+    def _start_background_init(self):
+        """后台获取access_token，并预热依赖模块和到chatglm.cn的连接"""
+        def background_init():
+            try:
+                if not self.refresh_access_token():
+                    logger.error("[ZPHH] Failed to refresh access token on initialization")
+            finally:
+                # 无论成功与否都放行等待中的请求，失败时由401重试逻辑兜底
+                self._token_ready.set()
+            self._prewarm()
+
+        thread = threading.Thread(target=background_init, daemon=True)
+        thread.start()
+
+    def _prewarm(self):
+        """预先导入较重的模块并建立TLS连接，减少首个请求的延迟"""
+        try:
+            from PIL import Image  # noqa: F401
+            from requests_toolbelt.multipart.encoder import MultipartEncoder  # noqa: F401
+        except Exception as e:
+            logger.warning(f"[ZPHH] 预加载依赖模块失败: {e}")
+        try:
+            # 建立连接后放回连接池，后续请求直接复用
+            self.session.head("https://chatglm.cn/", timeout=10, allow_redirects=False).close()
+            logger.debug("[ZPHH] 连接预热完成")
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"[ZPHH] 连接预热失败: {e}")
+
+    def _wait_token_ready(self, timeout=60):
+        """等待首次token刷新完成"""
+        if not self._token_ready.is_set():
+            logger.debug("[ZPHH] 等待access_token就绪...")
+            if not self._token_ready.wait(timeout):
+                logger.warning("[ZPHH] 等待access_token超时，继续请求")
+
     def _start_token_refresh_timer(self):
         """启动定时刷新token的线程"""
         def refresh_timer():
             while True:
+                if self._shared is not None:
+                    # 共享模式下频繁检查，token由最先发现过期的进程统一刷新
+                    time.sleep(60)
+                    self._sync_shared_token()
+                    continue
                 # 每隔1小时刷新一次token
                 time.sleep(3600)
                 logger.info("[ZPHH] Refreshing access token...")
@@ -73,6 +910,247 @@ class ZPHHPlugin(Plugin):
         thread = threading.Thread(target=refresh_timer, daemon=True)
         thread.start()
 
+    def _create_session(self):
+        """创建HTTP会话，按配置开启流量录制或使用录制的流量回放"""
+        replay_config = self.config.get('replay', {})
+        if isinstance(replay_config, dict) and replay_config.get('enabled', False):
+            path = os.path.join(os.path.dirname(__file__), replay_config.get('file', 'recordings/traffic.jsonl'))
+            try:
+                return _ReplaySession(path, replay_config.get('speed', 1.0), self._report_replay)
+            except Exception as e:
+                logger.error(f"[ZPHH] 加载回放流量失败，使用真实网络: {e}")
+
+        session = requests.Session()
+        record_config = self.config.get('record', {})
+        if isinstance(record_config, dict) and record_config.get('enabled', False):
+            try:
+                path = os.path.join(os.path.dirname(__file__), record_config.get('file', 'recordings/traffic.jsonl'))
+                log = _TraceLog(path, record_config.get('max_bytes', 20 * 1024 * 1024), record_config.get('backup_count', 2))
+                session = _RecordingSession(log, record_config.get('max_body_bytes', 1024 * 1024))
+                logger.info(f"[ZPHH] 已开启流量录制: {path}")
+            except Exception as e:
+                logger.error(f"[ZPHH] 开启流量录制失败: {e}")
+
+        adapter = _TimedAdapter(self._timeouts.record_connect, pool_connections=4, pool_maxsize=16)
+        session.mount("https://", adapter)
+        return session
+
+    def _create_timeouts(self):
+        """根据配置创建自适应超时，各类接口的上下限可以单独覆盖"""
+        # 上传时请求体在连接超时下发送，慢速链路需要更宽的连接超时
+        defaults = {
+            "poll": {"connect_floor": 3, "connect_ceiling": 10, "read_floor": 5, "read_ceiling": 20},
+            "create": {"connect_floor": 3, "connect_ceiling": 10, "read_floor": 10, "read_ceiling": 60},
+            "upload": {"connect_floor": 10, "connect_ceiling": 30, "read_floor": 15, "read_ceiling": 120},
+            "stream": {"connect_floor": 3, "connect_ceiling": 10, "read_floor": 30, "read_ceiling": 120},
+            "auth": {"connect_floor": 3, "connect_ceiling": 10, "read_floor": 5, "read_ceiling": 30},
+            "fetch": {"connect_floor": 3, "connect_ceiling": 15, "read_floor": 10, "read_ceiling": 60},
+            "default": {"connect_floor": 3, "connect_ceiling": 10, "read_floor": 10, "read_ceiling": 30},
+        }
+        timeouts_config = self.config.get('timeouts', {})
+        if not isinstance(timeouts_config, dict):
+            timeouts_config = {}
+        classes_config = timeouts_config.get('classes', {})
+        if not isinstance(classes_config, dict):
+            classes_config = {}
+        classes = {}
+        for name, bounds in defaults.items():
+            class_config = classes_config.get(name, {})
+            classes[name] = {**bounds, **class_config} if isinstance(class_config, dict) else bounds
+        return _AdaptiveTimeouts(
+            classes,
+            percentile=timeouts_config.get('percentile', 95),
+            multiplier=timeouts_config.get('multiplier', 3),
+            min_samples=timeouts_config.get('min_samples', 10),
+            window=timeouts_config.get('window', 200)
+        )
+
+    def _request_timeout(self, endpoint_class):
+        """返回该类接口当前的(连接超时, 读取超时)，不超过任务当前阶段剩余的时间"""
+        connect, read = self._timeouts.get(endpoint_class)
+        job = self._current_job()
+        if job is not None:
+            remaining = max(job.remaining(), 1)
+            connect, read = min(connect, remaining), min(read, remaining)
+        return connect, read
+
+    def _record_latency(self, endpoint_class, response):
+        """记录一次请求的首字节耗时"""
+        elapsed = getattr(response, 'elapsed', None)
+        if elapsed is not None:
+            self._timeouts.record_read(endpoint_class, elapsed.total_seconds())
+
+    def _report_replay(self, exchange, processing_ms, chunk_count):
+        """记录回放时处理一条响应的耗时，超过配置的上限时告警"""
+        endpoint = urlparse(exchange["url"]).path
+        with self._span("replay", endpoint=endpoint, chunks=chunk_count, processing_ms=round(processing_ms, 1)) as span:
+            max_processing_ms = self.config.get('replay', {}).get('max_processing_ms', 0)
+            if max_processing_ms and processing_ms > max_processing_ms:
+                span["outcome"] = "regression"
+                logger.warning(f"[ZPHH] 回放处理耗时超出上限: {endpoint}, {processing_ms:.1f}ms > {max_processing_ms}ms")
+            else:
+                logger.debug(f"[ZPHH] 回放处理耗时: {endpoint}, {processing_ms:.1f}ms, 分片{chunk_count}个")
+
+    def _sleep(self, seconds):
+        """轮询等待，任务被取消时立即返回并抛出_Aborted；回放模式下按回放速度缩短"""
+        if isinstance(self.session, _ReplaySession):
+            speed = self.config.get('replay', {}).get('speed', 1.0)
+            seconds = seconds / speed if speed > 0 else 0
+        job = self._current_job()
+        if job is None:
+            time.sleep(seconds)
+            return
+        job.cancelled.wait(max(0, min(seconds, job.remaining())))
+        job.check()
+
+    def _create_shared_state(self):
+        """根据配置创建多进程共享状态，未开启时返回None"""
+        shared_config = self.config.get('shared_state', {})
+        if not isinstance(shared_config, dict) or not shared_config.get('enabled', False):
+            return None
+        try:
+            path = shared_config.get('path') or os.path.join(os.path.dirname(__file__), "shared", "state.db")
+            shared = _SharedState(path)
+            logger.info(f"[ZPHH] 已启用多进程共享状态: {path}")
+            return shared
+        except Exception as e:
+            logger.error(f"[ZPHH] 创建共享状态失败，使用进程内状态: {e}")
+            return None
+
+    def _create_trace_log(self):
+        """根据配置创建任务追踪日志，未开启时返回None"""
+        trace_config = self.config.get('trace', {})
+        if not isinstance(trace_config, dict) or not trace_config.get('enabled', False):
+            return None
+        try:
+            path = os.path.join(os.path.dirname(__file__), trace_config.get('file', 'logs/trace.jsonl'))
+            return _TraceLog(path, trace_config.get('max_bytes', 5 * 1024 * 1024), trace_config.get('backup_count', 3))
+        except Exception as e:
+            logger.error(f"[ZPHH] 创建追踪日志失败: {e}")
+            return None
+
+    def _create_lanes(self):
+        """根据配置创建绘图和视频两个调度通道"""
+        defaults = {
+            "draw": {"capacity": 4, "per_user": 1, "max_queued_per_user": 2, "quota": 30, "window": 3600, "max_wait": 120},
+            "video": {"capacity": 2, "per_user": 1, "max_queued_per_user": 1, "quota": 5, "window": 3600, "max_wait": 600},
+        }
+        lanes_config = self.config.get('lanes', {})
+        if not isinstance(lanes_config, dict):
+            lanes_config = {}
+        lanes = {}
+        for name, options in defaults.items():
+            lane_config = lanes_config.get(name, {})
+            if isinstance(lane_config, dict):
+                options = {**options, **lane_config}
+            lanes[name] = _FairLane({"draw": "绘图", "video": "视频"}[name], **options)
+        return lanes
+
+    def _admit(self, job, e_context):
+        """为任务申请调度通道的名额，被拒绝时抛出_Rejected"""
+        lane = self._lanes.get(_JOB_LANES.get(job.kind))
+        if lane is None:
+            return
+
+        def on_queued(position):
+            e_context["channel"].send(Reply(ReplyType.TEXT, f"当前{lane.name}任务较多，已进入排队，前面还有{position}个任务"), e_context["context"])
+
+        with self._span("queue") as span:
+            reason = lane.acquire(job.user_id, job.group_id, on_queued=on_queued,
+                                  cancelled=job.cancelled, deadline=job.deadline)
+            if reason:
+                span["outcome"] = "rejected"
+                logger.info(f"[ZPHH] 任务被调度拒绝: {job.id}, {reason}")
+                raise _Rejected(reason)
+        job.lane = lane
+
+    def _release_slot(self, job, refund=False):
+        """释放任务占用的通道名额"""
+        if job is not None and job.lane is not None:
+            job.lane.release(job.user_id, job.group_id, refund=refund)
+            job.lane = None
+
+    def _current_job(self):
+        return getattr(self._local, 'job', None)
+
+    @contextlib.contextmanager
+    def _job(self, kind, context):
+        """在当前线程上开启一个任务，期间的所有请求和阶段都归属于该任务"""
+        deadlines = self.config.get('deadlines', {})
+        if not isinstance(deadlines, dict):
+            deadlines = {}
+        budget = deadlines.get(kind, _DEFAULT_DEADLINES.get(kind, 0))
+        job = _Job(kind, self._get_user_id(context), self._get_group_id(context), budget)
+        previous = self._current_job()
+        self._local.job = job
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+        job.start_watchdog()
+        logger.debug(f"[ZPHH] 任务开始: {job.id} ({kind})")
+        try:
+            with self._span("job", user=job.user_id):
+                yield job
+        finally:
+            job.stop_watchdog()
+            with self._jobs_lock:
+                self._jobs.pop(job.id, None)
+            self._local.job = previous
+
+    def _check_job(self):
+        """当前任务已取消或超时时抛出_Aborted"""
+        job = self._current_job()
+        if job is not None:
+            job.check()
+
+    @contextlib.contextmanager
+    def _span(self, stage, **attrs):
+        """划定任务的一个阶段：应用该阶段的时间预算，并在开启追踪时记录耗时"""
+        job = self._current_job()
+        if job is None:
+            with self._traced(stage, attrs):
+                yield attrs
+            return
+        previous = job.enter_stage(stage)
+        try:
+            # 已取消或超时的任务不再开始新的阶段，但已拿到的结果仍然发送
+            if stage not in ("job", "deliver", "replay"):
+                job.check()
+            with self._traced(stage, attrs):
+                yield attrs
+        finally:
+            job.stage_deadline = previous
+
+    @contextlib.contextmanager
+    def _traced(self, stage, attrs):
+        """记录一个阶段的开始时间和耗时，调用方可在attrs中补充字节数、状态等信息"""
+        if self._trace is None:
+            yield
+            return
+
+        job = self._current_job()
+        start_time = time.time()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException as e:
+            outcome = "cancelled" if isinstance(e, _Aborted) else "error"
+            attrs.setdefault("error", str(e))
+            raise
+        finally:
+            record = {
+                "ts": round(start_time, 3),
+                "job": job.id if job else None,
+                "kind": job.kind if job else None,
+                "stage": stage,
+                "ms": round((time.time() - start_time) * 1000, 1),
+                "outcome": attrs.pop("outcome", outcome),
+            }
+            record.update(attrs)
+            try:
+                self._trace.write(record)
+            except Exception as e:
+                logger.debug(f"[ZPHH] 写入追踪日志失败: {e}")
+
     def _load_config(self):
         """加载配置文件"""
         try:
@@ -90,7 +1168,9 @@ class ZPHHPlugin(Plugin):
     def get_unified_headers(self, content_type=None, additional_headers=None):
         """生成统一的请求头"""
         device_id = str(uuid.uuid4()).replace("-", "")
-        request_id = str(uuid.uuid4()).replace("-", "")
+        # 任务内的请求共用任务ID前缀，便于串联同一任务的所有调用
+        job = self._current_job()
+        request_id = job.next_request_id() if job else str(uuid.uuid4()).replace("-", "")
         timestamp = int(time.time() * 1000)
         
         # 基础请求头
@@ -129,41 +1209,73 @@ class ZPHHPlugin(Plugin):
         return headers
 
     def api_request(self, method, url, data=None, json_data=None, content_type=None, 
-                   additional_headers=None, retry_count=2, timeout=30):
-        """统一API请求方法"""
-        headers = self.get_unified_headers(content_type, additional_headers)
+                   additional_headers=None, retry_count=2, timeout=None, wait_token=True):
+        """统一API请求方法，未指定timeout时按接口类别使用学习到的超时"""
+        if wait_token:
+            self._wait_token_ready()
+        job = self._current_job()
+        endpoint_class = _endpoint_class(method, url)
+        fixed_timeout = timeout
         
-        for retry in range(retry_count):
-            try:
-                if method.upper() == 'GET':
-                    response = requests.get(url, headers=headers, params=data, timeout=timeout)
-                elif method.upper() == 'POST':
-                    if json_data:
-                        response = requests.post(url, headers=headers, json=json_data, timeout=timeout)
+        with self._span("http", method=method.upper(), endpoint=urlparse(url).path) as span:
+            for retry in range(retry_count):
+                span["retries"] = retry
+                # 每次都重新生成请求头，刷新token后的重试才会带上新的Authorization
+                headers = self.get_unified_headers(content_type, additional_headers)
+                if job is not None:
+                    job.check()
+                if fixed_timeout is None:
+                    timeout = self._request_timeout(endpoint_class)
+                elif job is not None:
+                    # 单次请求的超时不超过任务当前阶段剩余的时间
+                    timeout = min(fixed_timeout, max(job.remaining(), 1))
+                try:
+                    if method.upper() == 'GET':
+                        response = self.session.get(url, headers=headers, params=data, timeout=timeout)
+                    elif method.upper() == 'POST':
+                        if json_data:
+                            response = self.session.post(url, headers=headers, json=json_data, timeout=timeout)
+                        else:
+                            response = self.session.post(url, headers=headers, data=data, timeout=timeout)
+                    elif method.upper() == 'PUT':
+                        response = self.session.put(url, headers=headers, data=data, timeout=timeout)
                     else:
-                        response = requests.post(url, headers=headers, data=data, timeout=timeout)
-                elif method.upper() == 'PUT':
-                    response = requests.put(url, headers=headers, data=data, timeout=timeout)
-                else:
-                    logger.error(f"[ZPHH] Unsupported HTTP method: {method}")
-                    return None
-                
-                if response.status_code == 401 and retry < retry_count - 1:
-                    # 尝试刷新token
-                    if self.refresh_access_token():
-                        logger.info("[ZPHH] Token refreshed, retrying request")
-                        continue
-                
-                response.raise_for_status()
-                return response
-                
-            except requests.exceptions.RequestException as e:
-                if retry < retry_count - 1:
-                    logger.warning(f"[ZPHH] Request failed, retrying ({retry+1}/{retry_count}): {e}")
-                    time.sleep(1)
-                else:
-                    logger.error(f"[ZPHH] Request failed after {retry_count} attempts: {e}")
-                    return None
+                        logger.error(f"[ZPHH] Unsupported HTTP method: {method}")
+                        span["outcome"] = "error"
+                        return None
+                    
+                    span["http_status"] = response.status_code
+                    self._record_latency(endpoint_class, response)
+                    # 刷新token的请求本身不再触发刷新，避免递归
+                    if response.status_code == 401 and wait_token and retry < retry_count - 1:
+                        # 尝试刷新token
+                        if self.refresh_access_token():
+                            logger.info("[ZPHH] Token refreshed, retrying request")
+                            continue
+                    
+                    response.raise_for_status()
+                    body = response.request.body
+                    span["bytes_out"] = getattr(body, "len", None) or (len(body) if body else 0)
+                    span["bytes_in"] = len(response.content)
+                    return response
+                    
+                except requests.exceptions.RequestException as e:
+                    if fixed_timeout is None and isinstance(e, requests.exceptions.Timeout):
+                        # 超时的请求至少耗时这么久，计入样本，上游整体变慢时超时会随之放宽
+                        if isinstance(e, requests.exceptions.ConnectTimeout):
+                            self._timeouts.record_connect(timeout[0])
+                        else:
+                            self._timeouts.record_read(endpoint_class, timeout[1])
+                    # 创建任务和上传不是幂等的，请求可能已被上游处理，只在连接都没建立时重试
+                    retryable = endpoint_class not in ("create", "upload") or isinstance(e, requests.exceptions.ConnectTimeout)
+                    if retry < retry_count - 1 and retryable:
+                        logger.warning(f"[ZPHH] Request failed, retrying ({retry+1}/{retry_count}): {e}")
+                        self._sleep(1)
+                    else:
+                        logger.error(f"[ZPHH] Request failed after {retry+1} attempts: {e}")
+                        span["outcome"] = "error"
+                        span["error"] = str(e)
+                        return None
         
         return None
 
@@ -174,7 +1286,11 @@ class ZPHHPlugin(Plugin):
         draw_command = commands.get('draw', '绘') if isinstance(commands, dict) else '绘'
         video_ref_command = commands.get('video_ref', '智谱参考图') if isinstance(commands, dict) else '智谱参考图'
         video_command = commands.get('video', '智谱视频') if isinstance(commands, dict) else '智谱视频'
+        draw_video_command = commands.get('draw_video', '智谱绘视频') if isinstance(commands, dict) else '智谱绘视频'
         help_text += f"{draw_command} [提示词]: 生成图片\n"
+        help_text += f"{draw_video_command} [提示词]: 生成图片后直接转为视频\n"
+        cancel_command = commands.get('cancel', 'z取消') if isinstance(commands, dict) else 'z取消'
+        help_text += f"{cancel_command}: 取消自己正在排队或生成中的任务\n"
         help_text += f"{video_ref_command} [提示词]: 发送图片后生成视频\n"
         help_text += f"{video_command} [提示词]-[视频风格]-[情感氛围]-[运镜方式]-[比例]: 生成视频\n"
         help_text += "视频风格可选: 无/卡通3D/黑白老照片/油画/电影感\n"
@@ -183,6 +1299,58 @@ class ZPHHPlugin(Plugin):
         help_text += "比例可选: 1:1/16:9/9:16/3:4\n"
         return help_text
 
+    def on_receive_message(self, e_context: EventContext):
+        context = e_context["context"]
+        if context is None or context.type != ContextType.TEXT:
+            return
+        commands = self.config.get('commands', {})
+        cancel_command = commands.get('cancel', 'z取消') if isinstance(commands, dict) else 'z取消'
+        # 此时群聊消息尚未去掉@机器人的前缀
+        content = context.content.strip()
+        msg = context.kwargs.get('msg')
+        for name in (getattr(msg, 'self_display_name', None), getattr(msg, 'to_user_nickname', None)):
+            if name and content.startswith(f"@{name}"):
+                content = content[len(name) + 1:].strip(" \u2005")
+                break
+        if content != cancel_command:
+            return
+        # 发送者没有可取消的任务时不拦截，交给框架按@和前缀规则正常处理
+        if not self._has_user_jobs(context):
+            return
+        reply = self._cancel_user_jobs(context)
+        e_context["channel"].send(reply, context)
+        # 置空context，消息不再进入会话队列
+        e_context["context"] = None
+        e_context.action = EventAction.BREAK_PASS
+
+    def _has_user_jobs(self, context):
+        """发送者是否有排队中或执行中的任务，或等待中的参考图请求"""
+        user_id = self._get_user_id(context)
+        with self._jobs_lock:
+            if any(job.user_id == user_id for job in self._jobs.values()):
+                return True
+        waiting = self.waiting_for_image
+        return waiting is not None and self._get_user_id(waiting["context"]["context"]) == user_id
+
+    def _cancel_user_jobs(self, context):
+        """取消发送者排队中和执行中的所有任务，以及等待中的参考图请求"""
+        user_id = self._get_user_id(context)
+        with self._jobs_lock:
+            jobs = [job for job in self._jobs.values() if job.user_id == user_id]
+        for job in jobs:
+            logger.info(f"[ZPHH] 用户取消任务: {job.id} ({job.kind})")
+            job.cancel()
+
+        count = len(jobs)
+        waiting = self.waiting_for_image
+        if waiting is not None and self._get_user_id(waiting["context"]["context"]) == user_id:
+            self.waiting_for_image = None
+            count += 1
+
+        if not count:
+            return Reply(ReplyType.INFO, "当前没有进行中的任务")
+        return Reply(ReplyType.INFO, f"已取消{count}个任务")
+
     def on_handle_context(self, e_context: EventContext):
         if e_context["context"].type != ContextType.TEXT and e_context["context"].type != ContextType.IMAGE:
             return
@@ -194,9 +1362,12 @@ class ZPHHPlugin(Plugin):
                 logger.info("[ZPHH] 等待图片超时，重置状态")
                 self.waiting_for_image = None
 
-        # 处理图片消息
-        if e_context["context"].type == ContextType.IMAGE and self.waiting_for_image is not None:
-            self._process_received_image(e_context)
+        # 处理图片消息，没有等待中的参考图请求时在后台预先上传
+        if e_context["context"].type == ContextType.IMAGE:
+            if self.waiting_for_image is not None:
+                self._run_handler("video_ref", e_context, self._process_received_image, e_context)
+            else:
+                self._prefetch_image(e_context["context"])
             return
 
         content = e_context["context"].content
@@ -208,13 +1379,29 @@ class ZPHHPlugin(Plugin):
             e_context.action = EventAction.BREAK_PASS
             return
 
+        cancel_command = commands.get('cancel', 'z取消') if isinstance(commands, dict) else 'z取消'
+        if content == cancel_command:
+            e_context["reply"] = self._cancel_user_jobs(e_context["context"])
+            e_context.action = EventAction.BREAK_PASS
+            return
+
+        profile_command = commands.get('profile', 'z性能分析') if isinstance(commands, dict) else 'z性能分析'
+        if content.startswith(profile_command):
+            self._handle_profile_command(content, profile_command, e_context)
+            return
+
         draw_command = commands.get('draw', '绘') if isinstance(commands, dict) else '绘'
         video_ref_command = commands.get('video_ref', '智谱参考图') if isinstance(commands, dict) else '智谱参考图'
         video_command = commands.get('video', '智谱视频') if isinstance(commands, dict) else '智谱视频'
+        draw_video_command = commands.get('draw_video', '智谱绘视频') if isinstance(commands, dict) else '智谱绘视频'
         
-        # 先检查是否是文生视频命令
-        if content.startswith(video_command):
-            self._handle_video_command(content, video_command, e_context)
+        # 先检查是否是绘图转视频命令
+        if content.startswith(draw_video_command):
+            self._run_handler("draw_video", e_context, self._handle_draw_video_command, content, draw_video_command, e_context)
+            return
+        # 再检查是否是文生视频命令
+        elif content.startswith(video_command):
+            self._run_handler("video", e_context, self._handle_video_command, content, video_command, e_context)
             return
         # 再检查是否是参考图视频命令
         elif content.startswith(video_ref_command):
@@ -222,9 +1409,177 @@ class ZPHHPlugin(Plugin):
             return
         # 最后检查是否是绘画命令
         elif content.startswith(draw_command):
-            self._handle_draw_command(content, draw_command, e_context)
+            self._run_handler("draw", e_context, self._handle_draw_command, content, draw_command, e_context)
             return
 
+    def _get_user_id(self, context):
+        """获取发送者ID，群聊中为实际发言人"""
+        msg = context.kwargs.get('msg')
+        if msg is not None:
+            user_id = getattr(msg, 'actual_user_id', None) or getattr(msg, 'from_user_id', None)
+            if user_id:
+                return user_id
+        return context.kwargs.get('session_id') or ""
+
+    def _get_group_id(self, context):
+        """获取群聊ID，私聊时为空"""
+        msg = context.kwargs.get('msg')
+        if not context.kwargs.get('isgroup') or msg is None:
+            return ""
+        return getattr(msg, 'other_user_id', None) or getattr(msg, 'from_user_id', None) or ""
+
+    def _is_admin(self, context):
+        """判断发送者是否在配置的管理员列表中"""
+        admin_users = self.config.get('admin_users', [])
+        return isinstance(admin_users, list) and self._get_user_id(context) in admin_users
+
+    def _handle_profile_command(self, content, profile_command, e_context):
+        """处理性能分析命令，对接下来的N个请求开启性能分析"""
+        if not self._is_admin(e_context["context"]):
+            e_context["reply"] = Reply(ReplyType.ERROR, "只有管理员可以使用性能分析命令")
+            e_context.action = EventAction.BREAK_PASS
+            return
+
+        arg = content[len(profile_command):].strip()
+        count = int(arg) if arg.isdigit() else 1
+        with self._profile_lock:
+            self._profile_remaining = count
+        if count:
+            reply_text = f"将对接下来的{count}个请求进行性能分析，结果保存在: {self._profile_dir()}"
+        else:
+            reply_text = "已关闭性能分析"
+        e_context["reply"] = Reply(ReplyType.INFO, reply_text)
+        e_context.action = EventAction.BREAK_PASS
+
+    def _profile_config(self):
+        profile_config = self.config.get('profile', {})
+        return profile_config if isinstance(profile_config, dict) else {}
+
+    def _profile_dir(self):
+        return os.path.join(os.path.dirname(__file__), self._profile_config().get('dir', 'profiles'))
+
+    def _run_handler(self, name, e_context, handler, *args):
+        """以任务形式执行命令处理函数，需要时附加cProfile和tracemalloc分析"""
+        with self._job(name, e_context["context"]):
+            # 未开启时只做两次属性读取，开销可以忽略
+            if not self._profile_remaining and not self._profile_config().get('enabled', False):
+                return handler(*args)
+
+            with self._profile_lock:
+                profile = self._profile_remaining > 0 or self._profile_config().get('enabled', False)
+                if self._profile_remaining:
+                    self._profile_remaining -= 1
+            if not profile:
+                return handler(*args)
+            return self._run_profiled(name, handler, *args)
+
+    def _coalesce(self, key, run, join, e_context):
+        """合并参数相同的并发任务；需要自己执行时先申请调度通道的名额"""
+        job = self._current_job()
+        with self._span("generate") as span:
+            def lead():
+                # 排队期间相同任务恰好结束时，才会在这里补申请名额
+                if job.lane is None:
+                    self._admit(job, e_context)
+                return run()
+
+            def on_join():
+                span["coalesced"] = True
+                # 复用他人的结果时不占用名额，也不计入配额
+                self._release_slot(job, refund=True)
+                join()
+
+            try:
+                # 相同任务已在执行时直接等待结果，不必排队
+                if not self._inflight.running(key):
+                    self._admit(job, e_context)
+                # 本人取消或被调度拒绝只影响自己，合并进来的其他用户改由自己执行
+                return self._inflight.do(key, lead, on_join=on_join, check=job.check,
+                                         personal=(_Cancelled, _Rejected))
+            finally:
+                self._release_slot(job)
+
+    def _run_profiled(self, name, handler, *args):
+        """在cProfile和tracemalloc下执行处理函数并写出分析结果"""
+        import cProfile
+        import tracemalloc
+
+        # tracemalloc是全局的，多个请求同时分析时由最后一个结束的请求关闭
+        with self._profile_lock:
+            if self._tracemalloc_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self._tracemalloc_owned = True
+            self._tracemalloc_users += 1
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 同一时刻只能有一个cProfile生效，此时只记录内存分配
+            profiler = None
+
+        start_time = time.time()
+        try:
+            return handler(*args)
+        finally:
+            elapsed = time.time() - start_time
+            if profiler:
+                profiler.disable()
+            snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+            with self._profile_lock:
+                self._tracemalloc_users -= 1
+                if self._tracemalloc_users == 0 and self._tracemalloc_owned:
+                    tracemalloc.stop()
+                    self._tracemalloc_owned = False
+            self._write_profile(name, profiler, snapshot, elapsed)
+
+    def _write_profile(self, name, profiler, snapshot, elapsed):
+        """写出单个请求的分析文件，并限制目录中的文件数量"""
+        try:
+            import pstats
+            import tracemalloc
+
+            profile_config = self._profile_config()
+            top_n = profile_config.get('top_n', 20)
+            profile_dir = self._profile_dir()
+            os.makedirs(profile_dir, exist_ok=True)
+
+            base_name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{name}_{uuid.uuid4().hex[:8]}"
+            summary = io.StringIO()
+            summary.write(f"handler: {name}\nelapsed: {elapsed:.3f}s\n\n")
+
+            if profiler:
+                profiler.dump_stats(os.path.join(profile_dir, base_name + ".prof"))
+                summary.write("== top functions (cumulative) ==\n")
+                pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(top_n)
+
+            if snapshot:
+                snapshot = snapshot.filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                ))
+                summary.write("== top allocations ==\n")
+                for stat in snapshot.statistics("lineno")[:top_n]:
+                    summary.write(f"{stat}\n")
+
+            with open(os.path.join(profile_dir, base_name + ".txt"), "w", encoding="utf-8") as f:
+                f.write(summary.getvalue())
+            logger.info(f"[ZPHH] 性能分析结果已保存: {base_name}, 耗时: {elapsed:.3f}s")
+
+            # 只保留最近max_files个请求的分析结果，同一请求的.prof和.txt一起删除
+            max_files = profile_config.get('max_files', 50)
+            by_request = collections.defaultdict(list)
+            for f in os.listdir(profile_dir):
+                stem, ext = os.path.splitext(f)
+                if ext in (".prof", ".txt"):
+                    by_request[stem].append(os.path.join(profile_dir, f))
+            stems = sorted(by_request, key=lambda stem: max(os.path.getmtime(path) for path in by_request[stem]))
+            for stem in stems[:-max_files] if len(stems) > max_files else []:
+                for file_path in by_request[stem]:
+                    os.remove(file_path)
+        except Exception as e:
+            logger.error(f"[ZPHH] 保存性能分析结果失败: {e}")
+
     def _handle_draw_command(self, content, draw_command, e_context):
         """处理绘画命令"""
         try:
@@ -235,67 +1590,129 @@ class ZPHHPlugin(Plugin):
                 e_context.action = EventAction.BREAK_PASS
                 return
 
-            # 发送等待消息
-            e_context["reply"] = Reply(ReplyType.INFO, "正在生成图片,请稍候...")
-            e_context["channel"].send(e_context["reply"], e_context["context"])
-
-            # 构建请求数据
-            data = {
-                "assistant_id": "65a232c082ff90a2ad2f15e2",  # 固定的绘画助手ID
-                "conversation_id": self.conversation_id,
-                "meta_data": {
-                    "cogview": {
-                        "aspect_ratio": "1:1",
-                        "style": "none",
-                        "scene": "none"
-                    },
-                    "if_plus_model": False,
-                    "is_test": False,
-                    "input_question_type": "xxxx",
-                    "channel": "",
-                    "platform": "pc"
+            def run():
+                # 发送等待消息
+                e_context["channel"].send(Reply(ReplyType.INFO, "正在生成图片,请稍候..."), e_context["context"])
+                return self._generate_image(prompt)
+
+            def join():
+                e_context["channel"].send(Reply(ReplyType.INFO, "相同的绘图任务正在进行中,完成后将一并发送结果"), e_context["context"])
+
+            # 相同提示词的并发请求合并为一次上游调用
+            key = ("draw", " ".join(prompt.split()))
+            image_url, text_response = self._coalesce(key, run, join, e_context)
+
+            # 发送最终回复
+            if image_url:
+                image_reply = Reply(ReplyType.IMAGE_URL, image_url)
+                e_context["reply"] = image_reply
+                with self._span("deliver"):
+                    e_context["channel"].send(e_context["reply"], e_context["context"])
+
+            if text_response:
+                text_reply = Reply(ReplyType.TEXT, text_response)
+                e_context["reply"] = text_reply
+            elif not image_url:
+                e_context["reply"] = Reply(ReplyType.ERROR, "图片生成失败")
+
+            e_context.action = EventAction.BREAK_PASS
+            
+        except (_Rejected, _Aborted) as e:
+            e_context["reply"] = Reply(ReplyType.TEXT, str(e))
+            e_context.action = EventAction.BREAK_PASS
+        except Exception as e:
+            logger.error(f"[ZPHH] 处理绘图请求失败: {e}")
+            e_context["reply"] = Reply(ReplyType.ERROR, "绘图请求处理失败,请稍后重试")
+            e_context.action = EventAction.BREAK_PASS
+
+    def _generate_image(self, prompt):
+        """调用绘画助手生成图片，返回(图片URL, 文本回复)"""
+        # 构建请求数据
+        data = {
+            "assistant_id": "65a232c082ff90a2ad2f15e2",  # 固定的绘画助手ID
+            "conversation_id": self.conversation_id,
+            "meta_data": {
+                "cogview": {
+                    "aspect_ratio": "1:1",
+                    "style": "none",
+                    "scene": "none"
                 },
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ]
-            }
+                "if_plus_model": False,
+                "is_test": False,
+                "input_question_type": "xxxx",
+                "channel": "",
+                "platform": "pc"
+            },
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": prompt
+                        }
+                    ]
+                }
+            ]
+        }
 
+        with self._span("stream") as span:
+            start_time = time.time()
             # 发送绘图请求
-            response = requests.post(
-                "https://chatglm.cn/chatglm/backend-api/assistant/stream",
-                json=data,
-                headers=self.get_unified_headers(),
-                stream=True,
-                timeout=30
-            )
+            self._wait_token_ready()
+            job = self._current_job()
+            for attempt in range(2):
+                response = self.session.post(
+                    "https://chatglm.cn/chatglm/backend-api/assistant/stream",
+                    json=data,
+                    headers=self.get_unified_headers(),
+                    stream=True,
+                    timeout=self._request_timeout("stream")
+                )
+                # token失效时刷新后重试一次，与api_request的处理一致
+                if response.status_code == 401 and attempt == 0:
+                    response.close()
+                    if self.refresh_access_token():
+                        logger.info("[ZPHH] Token refreshed, retrying request")
+                        continue
+                break
+            self._record_latency("stream", response)
+            # 取消或超时时由任务关闭该流，阻塞中的读取会立即结束
+            if job is not None:
+                job.track(response)
             response.raise_for_status()
+            span["http_status"] = response.status_code
 
             # 处理流式响应
             text_response = ""
             image_url = ""
             last_text = ""
-            
-            for line in response.iter_lines():
+            frames = 0
+            bytes_in = 0
+            # 读取超时同样约束两行之间的间隔，最长间隔也计入样本
+            last_line_time = time.monotonic()
+            max_gap = 0
+
+            for line in self._iter_stream_lines(response):
+                now = time.monotonic()
+                max_gap = max(max_gap, now - last_line_time)
+                last_line_time = now
                 if not line:
                     continue
-                    
+
+                bytes_in += len(line)
                 line = line.decode('utf-8')
                 if line.startswith("event:"):
                     continue
-                    
+                
                 if line.startswith("data:"):
+                    frames += 1
+                    if frames == 1:
+                        span["first_frame_ms"] = round((time.time() - start_time) * 1000, 1)
                     try:
                         data = json.loads(line[5:])
                         logger.debug(f"[ZPHH] Received data: {data}")
-                        
+                    
                         if "parts" in data:
                             for part in data["parts"]:
                                 if part.get("content"):
@@ -310,33 +1727,90 @@ class ZPHHPlugin(Plugin):
                                                 if img.get("image_url"):
                                                     image_url = img["image_url"]
                                                     break
-                                                    
+                                                
                         if "conversation_id" in data:
                             self.conversation_id = data["conversation_id"]
-                            
+                        
                     except json.JSONDecodeError as e:
                         logger.error(f"[ZPHH] JSON decode error: {e}")
                         continue
 
-            # 发送最终回复
-            if image_url:
-                image_reply = Reply(ReplyType.IMAGE_URL, image_url)
-                e_context["reply"] = image_reply
-                e_context["channel"].send(e_context["reply"], e_context["context"])
+            span["frames"] = frames
+            span["bytes_in"] = bytes_in
+            # 流因取消被提前关闭时，不把不完整的结果当作成功
+            self._check_job()
+            self._timeouts.record_read("stream", max_gap)
 
-            if text_response:
-                text_reply = Reply(ReplyType.TEXT, text_response)
-                e_context["reply"] = text_reply
-            elif not image_url:
-                e_context["reply"] = Reply(ReplyType.ERROR, "图片生成失败")
+        return image_url, text_response
 
+    def _handle_draw_video_command(self, content, draw_video_command, e_context):
+        """处理绘图转视频命令，生成图片后直接作为参考图生成视频"""
+        try:
+            prompt = content[len(draw_video_command):].strip()
+            if not prompt:
+                e_context["reply"] = Reply(ReplyType.TEXT, "请在命令后输入提示词")
+                e_context.action = EventAction.BREAK_PASS
+                return
+
+            def run():
+                # 发送等待消息
+                e_context["channel"].send(Reply(ReplyType.TEXT, "正在生成图片并转为视频，请稍候..."), e_context["context"])
+                return self._generate_draw_video(prompt)
+
+            def join():
+                e_context["channel"].send(Reply(ReplyType.TEXT, "相同的视频任务正在进行中，完成后将一并发送结果"), e_context["context"])
+
+            key = ("draw_video", " ".join(prompt.split()))
+            image_url, video_url, error = self._coalesce(key, run, join, e_context)
+
+            with self._span("deliver"):
+                if image_url:
+                    e_context["channel"].send(Reply(ReplyType.IMAGE_URL, image_url), e_context["context"])
+                if video_url:
+                    e_context["channel"].send(Reply(ReplyType.VIDEO_URL, video_url), e_context["context"])
+
+            e_context["reply"] = Reply(ReplyType.TEXT, "视频生成成功！" if video_url else error)
+            e_context.action = EventAction.BREAK_PASS
+
+        except (_Rejected, _Aborted) as e:
+            e_context["reply"] = Reply(ReplyType.TEXT, str(e))
             e_context.action = EventAction.BREAK_PASS
-            
         except Exception as e:
-            logger.error(f"[ZPHH] 处理绘图请求失败: {e}")
-            e_context["reply"] = Reply(ReplyType.ERROR, "绘图请求处理失败,请稍后重试")
+            logger.error(f"[ZPHH] 处理绘图转视频请求失败: {e}")
+            e_context["reply"] = Reply(ReplyType.TEXT, f"处理绘图转视频请求失败: {str(e)}")
             e_context.action = EventAction.BREAK_PASS
 
+    def _generate_draw_video(self, prompt):
+        """生成图片后把图片直接转发给上传接口并生成视频，返回(图片URL, 视频URL, 失败提示)"""
+        image_url, _ = self._generate_image(prompt)
+        if not image_url:
+            return None, None, "图片生成失败"
+
+        with self._span("upload", streamed=True) as span:
+            source_id, source_url = self._upload_image_from_url(image_url)
+            if not source_id or not source_url:
+                span["outcome"] = "failed"
+                return image_url, None, "上传图片失败，请稍后重试"
+
+        logger.info(f"[ZPHH] 开始发送绘图转视频请求，提示词: {prompt}, 图片ID: {source_id}")
+        with self._span("create") as span:
+            task_id = self._send_video_gen_request(prompt, source_id)
+            if not task_id:
+                span["outcome"] = "failed"
+                return image_url, None, "创建视频任务失败，请稍后重试"
+
+        video_url, error = self._wait_video(task_id)
+        return image_url, video_url, error
+
+    def _iter_stream_lines(self, response):
+        """逐行读取流式响应，流因任务取消或超时被关闭时抛出_Aborted"""
+        try:
+            for line in response.iter_lines():
+                yield line
+        except Exception:
+            self._check_job()
+            raise
+
     def _handle_video_ref_command(self, content, video_ref_command, e_context):
         """处理参考图视频命令"""
         try:
@@ -347,6 +1821,12 @@ class ZPHHPlugin(Plugin):
                 e_context.action = EventAction.BREAK_PASS
                 return
 
+            # 刚发送过图片时直接使用预先上传的结果
+            prefetched = self._take_prefetched(e_context["context"])
+            if prefetched is not None:
+                self._run_handler("video_ref", e_context, self._process_prefetched_image, prompt, prefetched, e_context)
+                return
+
             # 发送等待消息，提示用户发送图片
             e_context["reply"] = Reply(ReplyType.TEXT, "请发送一张参考图片")
             
@@ -365,6 +1845,140 @@ class ZPHHPlugin(Plugin):
             e_context["reply"] = Reply(ReplyType.TEXT, f"参考图视频请求处理失败: {str(e)}")
             e_context.action = EventAction.BREAK_PASS
     
+    def _prefetch_config(self):
+        prefetch_config = self.config.get('prefetch', {})
+        return prefetch_config if isinstance(prefetch_config, dict) else {}
+
+    def _prefetch_key(self, context):
+        return context.kwargs.get('session_id') or "", self._get_user_id(context)
+
+    def _prefetch_image(self, context):
+        """在后台读取并上传刚收到的图片，供随后的参考图命令直接使用"""
+        prefetch_config = self._prefetch_config()
+        if not prefetch_config.get('enabled', False):
+            return
+        if context.kwargs.get('isgroup') and not prefetch_config.get('group_chats', False):
+            return
+
+        key = self._prefetch_key(context)
+        # 在处理线程中同步下载完图片再交给预取线程，框架随后的图片处理看到_prepared
+        # 已置位会直接跳过，预取线程不会读到写了一半的文件
+        msg = context.kwargs.get('msg')
+        try:
+            if hasattr(msg, '_prepare_fn') and not getattr(msg, '_prepared', False):
+                setattr(msg, '_prepared', True)
+                msg._prepare_fn()
+            if not os.path.isfile(context.content):
+                raise IOError(f"图片文件不存在: {context.content}")
+        except Exception as e:
+            logger.warning(f"[ZPHH] 获取图片失败，跳过预先上传: {e}")
+            # 不能再沿用这之前的旧图片
+            with self._prefetch_lock:
+                self._prefetched.pop(key, None)
+            return
+
+        entry = _PrefetchedImage(context.content)
+        ttl = prefetch_config.get('ttl', 300)
+        with self._prefetch_lock:
+            # 每个会话只保留最新的一张，顺便清理过期的记录
+            for stale_key in [k for k, v in self._prefetched.items() if v.expired(ttl)]:
+                del self._prefetched[stale_key]
+            self._prefetched[key] = entry
+
+        thread = threading.Thread(target=self._run_prefetch, args=(key, entry), daemon=True)
+        thread.start()
+
+    def _run_prefetch(self, key, entry):
+        """预取线程：限制并发上传数，排到时图片已被替换或过期则直接放弃"""
+        try:
+            with self._prefetch_slots:
+                with self._prefetch_lock:
+                    if self._prefetched.get(key) is not entry:
+                        return
+                if entry.expired(self._prefetch_config().get('ttl', 300)):
+                    return
+
+                with self._span("fetch", prefetch=True) as span:
+                    with open(entry.image_path, 'rb') as f:
+                        image_data = f.read()
+                    span["bytes_in"] = len(image_data)
+                entry.digest = hashlib.sha1(image_data).hexdigest()
+
+                with self._span("upload", prefetch=True, bytes_out=len(image_data)) as span:
+                    source_id, _ = self._upload_image(image_data)
+                    if not source_id:
+                        span["outcome"] = "failed"
+                if source_id:
+                    entry.source_id = source_id
+                    logger.info(f"[ZPHH] 已预先上传图片: {source_id}")
+                else:
+                    entry.image_data = image_data
+        except Exception as e:
+            logger.warning(f"[ZPHH] 预先上传图片失败: {e}")
+        finally:
+            entry.done.set()
+
+    def _take_prefetched(self, context):
+        """取出发送者最近一张未过期的预取图片，每张只用一次，没有时返回None"""
+        if not self._prefetch_config().get('enabled', False):
+            return None
+        with self._prefetch_lock:
+            entry = self._prefetched.pop(self._prefetch_key(context), None)
+        if entry is None or entry.expired(self._prefetch_config().get('ttl', 300)):
+            return None
+        return entry
+
+    def _process_prefetched_image(self, prompt, entry, e_context):
+        """使用预先上传的图片生成参考图视频"""
+        try:
+            # 预取尚未完成时等它结束，比重新开始读取和上传更快
+            job = self._current_job()
+            with self._span("prefetch"):
+                while not entry.done.wait(1):
+                    job.check()
+
+            if entry.digest is None:
+                # 预取没能读到图片，退回到先发命令再发图片的流程
+                self.waiting_for_image = {
+                    "prompt": prompt,
+                    "context": e_context
+                }
+                self.waiting_for_image_timestamp = time.time()
+                e_context["reply"] = Reply(ReplyType.TEXT, "请发送一张参考图片")
+                e_context.action = EventAction.BREAK_PASS
+                return
+
+            def run():
+                # 发送等待消息
+                e_context["channel"].send(Reply(ReplyType.TEXT, "正在使用刚才的图片生成视频，请稍候..."), e_context["context"])
+                return self._generate_ref_video(prompt, entry.image_data, entry.source_id)
+
+            def join():
+                e_context["channel"].send(Reply(ReplyType.TEXT, "相同的视频任务正在进行中，完成后将一并发送结果"), e_context["context"])
+
+            key = ("video_ref", " ".join(prompt.split()), entry.digest)
+            video_url, error = self._coalesce(key, run, join, e_context)
+            if not video_url:
+                e_context["reply"] = Reply(ReplyType.TEXT, error)
+                e_context.action = EventAction.BREAK_PASS
+                return
+
+            # 发送视频URL
+            video_reply = Reply(ReplyType.VIDEO_URL, video_url)
+            with self._span("deliver"):
+                e_context["channel"].send(video_reply, e_context["context"])
+
+            e_context["reply"] = Reply(ReplyType.TEXT, "视频生成成功！")
+            e_context.action = EventAction.BREAK_PASS
+
+        except (_Rejected, _Aborted) as e:
+            e_context["reply"] = Reply(ReplyType.TEXT, str(e))
+            e_context.action = EventAction.BREAK_PASS
+        except Exception as e:
+            logger.error(f"[ZPHH] 处理参考图视频请求失败: {e}")
+            e_context["reply"] = Reply(ReplyType.TEXT, f"参考图视频请求处理失败: {str(e)}")
+            e_context.action = EventAction.BREAK_PASS
+
     def _get_image_data(self, msg, content):
         """精确获取用户发送的图片"""
         try:
@@ -398,7 +2012,8 @@ class ZPHHPlugin(Plugin):
             # 2. 处理URL类型
             if isinstance(content, str) and (content.startswith('http://') or content.startswith('https://')):
                 logger.info(f"[ZPHH] 下载URL图片: {content}")
-                response = requests.get(content, timeout=30)
+                response = self.session.get(content, timeout=self._request_timeout("fetch"))
+                self._record_latency("fetch", response)
                 if response.status_code == 200:
                     temp_file = os.path.join(self.user_upload_dir, f"url_upload_{uuid.uuid4()}.jpg")
                     with open(temp_file, 'wb') as f:
@@ -468,8 +2083,10 @@ class ZPHHPlugin(Plugin):
             
             # 读取图片数据
             try:
-                with open(image_path, 'rb') as f:
-                    image_data = f.read()
+                with self._span("fetch") as span:
+                    with open(image_path, 'rb') as f:
+                        image_data = f.read()
+                    span["bytes_in"] = len(image_data)
                 logger.info(f"[ZPHH] 成功读取图片: {image_path}, 大小: {len(image_data)} 字节")
             except Exception as e:
                 logger.error(f"[ZPHH] 读取图片失败: {e}")
@@ -482,37 +2099,26 @@ class ZPHHPlugin(Plugin):
             prompt = self.waiting_for_image["prompt"]
             original_context = self.waiting_for_image["context"]
             
-            # 上传图片到服务器
-            source_id, source_url = self._upload_image(image_data)
-            if not source_id or not source_url:
-                original_context["reply"] = Reply(ReplyType.TEXT, "上传图片失败，请稍后重试")
-                original_context.action = EventAction.BREAK_PASS
-                return
-            
-            # 发送视频生成请求 
-            logger.info(f"[ZPHH] 开始发送参考图视频生成请求，提示词: {prompt}, 图片ID: {source_id}")
+            def run():
+                # 发送等待消息
+                original_context["channel"].send(Reply(ReplyType.TEXT, "正在生成视频，请稍候..."), original_context["context"])
+                return self._generate_ref_video(prompt, image_data)
             
-            # 发送等待消息
-            original_context["reply"] = Reply(ReplyType.TEXT, "正在生成视频，请稍候...")
-            original_context["channel"].send(original_context["reply"], original_context["context"])
+            def join():
+                original_context["channel"].send(Reply(ReplyType.TEXT, "相同的视频任务正在进行中，完成后将一并发送结果"), original_context["context"])
             
-            # 发送视频生成请求
-            task_id = self._send_video_gen_request(prompt, source_id)
-            if not task_id:
-                original_context["reply"] = Reply(ReplyType.TEXT, "创建视频任务失败，请稍后重试")
-                original_context.action = EventAction.BREAK_PASS
-                return
-            
-            # 轮询检查视频生成状态
-            video_url = self._check_video_status(task_id)
+            # 同一张图片和提示词的并发请求合并为一次上游调用
+            key = ("video_ref", " ".join(prompt.split()), hashlib.sha1(image_data).hexdigest())
+            video_url, error = self._coalesce(key, run, join, e_context)
             if not video_url:
-                original_context["reply"] = Reply(ReplyType.TEXT, "获取视频结果失败，请稍后重试")
+                original_context["reply"] = Reply(ReplyType.TEXT, error)
                 original_context.action = EventAction.BREAK_PASS
                 return
             
             # 发送视频URL
             video_reply = Reply(ReplyType.VIDEO_URL, video_url)
-            original_context["channel"].send(video_reply, original_context["context"])
+            with self._span("deliver"):
+                original_context["channel"].send(video_reply, original_context["context"])
             
             # 发送成功消息
             original_context["reply"] = Reply(ReplyType.TEXT, "视频生成成功！")
@@ -521,6 +2127,12 @@ class ZPHHPlugin(Plugin):
             # 最后重要的是：处理完后重置状态
             self.waiting_for_image = None
             
+        except _Rejected as e:
+            # 保留等待图片的状态，用户稍后重新发送图片即可
+            e_context["reply"] = Reply(ReplyType.TEXT, str(e))
+        except _Aborted as e:
+            e_context["reply"] = Reply(ReplyType.TEXT, str(e))
+            self.waiting_for_image = None
         except Exception as e:
             logger.error(f"[ZPHH] 处理图片失败: {e}")
             if self.waiting_for_image and self.waiting_for_image["context"]:
@@ -529,6 +2141,35 @@ class ZPHHPlugin(Plugin):
         
         e_context.action = EventAction.BREAK_PASS
 
+    def _generate_ref_video(self, prompt, image_data, source_id=None):
+        """上传参考图并生成视频，返回(视频URL, 失败提示)；已预先上传时直接使用source_id"""
+        # 上传图片到服务器
+        if not source_id:
+            with self._span("upload", bytes_out=len(image_data)) as span:
+                source_id, source_url = self._upload_image(image_data)
+                if not source_id or not source_url:
+                    span["outcome"] = "failed"
+                    return None, "上传图片失败，请稍后重试"
+        
+        # 发送视频生成请求 
+        logger.info(f"[ZPHH] 开始发送参考图视频生成请求，提示词: {prompt}, 图片ID: {source_id}")
+        with self._span("create") as span:
+            task_id = self._send_video_gen_request(prompt, source_id)
+            if not task_id:
+                span["outcome"] = "failed"
+                return None, "创建视频任务失败，请稍后重试"
+        
+        return self._wait_video(task_id)
+
+    def _wait_video(self, task_id):
+        """轮询检查视频生成状态，返回(视频URL, 失败提示)"""
+        with self._span("poll", chat_id=task_id) as span:
+            video_url = self._check_video_status(task_id)
+            if not video_url:
+                span["outcome"] = "failed"
+                return None, "获取视频结果失败，请稍后重试"
+        return video_url, None
+
     def _clean_user_uploads(self):
         """清理用户上传目录中的历史文件"""
         try:
@@ -560,6 +2201,7 @@ class ZPHHPlugin(Plugin):
             
             # 获取图片的实际尺寸
             try:
+                from PIL import Image
                 img = Image.open(io.BytesIO(image_data))
                 width, height = img.size
                 logger.info(f"[ZPHH] 获取到图片实际尺寸: {width}x{height}")
@@ -570,12 +2212,6 @@ class ZPHHPlugin(Plugin):
             # 生成随机文件名
             file_name = f"n_v{random.getrandbits(128):032x}.jpg"
             
-            # 准备额外的头部信息
-            additional_headers = {
-                'Content-Type': 'multipart/form-data',
-                'stepchat-meta-size': str(file_size)
-            }
-            
             # 准备表单数据
             from requests_toolbelt.multipart.encoder import MultipartEncoder
             multipart_data = MultipartEncoder(
@@ -586,34 +2222,89 @@ class ZPHHPlugin(Plugin):
                 }
             )
             
-            # 更新Content-Type
-            additional_headers['Content-Type'] = multipart_data.content_type
+            return self._post_upload(multipart_data, multipart_data.content_type, file_size)
             
-            # 发送上传请求
-            upload_url = 'https://chatglm.cn/chatglm/video-api/v1/static/upload'
-            response = self.api_request(
-                'POST', 
-                upload_url, 
-                data=multipart_data,
-                additional_headers=additional_headers
-            )
+        except _Aborted:
+            raise
+        except Exception as e:
+            logger.error(f"[ZPHH] 上传图片失败: {e}")
+            return None, None
+
+    def _upload_image_from_url(self, image_url, chunk_size=64 * 1024):
+        """把图片URL的内容分块转发到上传接口，不落盘，内存中只保留文件头和当前块"""
+        try:
+            response = self.session.get(image_url, stream=True, timeout=self._request_timeout("fetch"))
+            self._record_latency("fetch", response)
+            response.raise_for_status()
+            file_size = int(response.headers.get('Content-Length') or 0)
+            file_type = response.headers.get('Content-Type') or 'image/jpeg'
+            chunks = response.iter_content(chunk_size)
             
-            if not response:
-                return None, None
+            # 只读取足够解析尺寸的文件头
+            from PIL import Image
+            head = b""
+            width, height = 800, 800
+            for chunk in chunks:
+                head += chunk
+                try:
+                    width, height = Image.open(io.BytesIO(head)).size
+                    break
+                except Exception:
+                    if len(head) >= 1024 * 1024:
+                        logger.error("[ZPHH] 获取图片尺寸失败，使用默认值")
+                        break
+            logger.info(f"[ZPHH] 获取到图片实际尺寸: {width}x{height}")
             
-            data = response.json()
-            if data["status"] == 0:
-                source_id = data["result"]["source_id"]
-                source_url = data["result"]["source_url"]
-                logger.info(f"[ZPHH] 图片上传成功: {source_id}")
-                return source_id, source_url
+            if not file_size:
+                # 服务器没有返回长度时无法流式上传，读入内存后按普通方式上传
+                return self._upload_image(head + b"".join(chunks))
             
-            logger.error(f"[ZPHH] 图片上传失败: {data}")
-            return None, None
+            body = _MultipartStream(
+                {'width': str(width), 'height': str(height)},
+                'blob',
+                file_type,
+                file_size,
+                itertools.chain([head], chunks)
+            )
+            # 请求体只能发送一次，因此不重试
+            return self._post_upload(body, body.content_type, file_size, retry_count=1)
             
+        except _Aborted:
+            raise
         except Exception as e:
-            logger.error(f"[ZPHH] 上传图片失败: {e}")
+            logger.error(f"[ZPHH] 转发图片失败: {e}")
+            return None, None
+
+    def _post_upload(self, body, content_type, file_size, retry_count=2):
+        """发送上传请求并解析返回的source_id和source_url"""
+        # 准备额外的头部信息
+        additional_headers = {
+            'Content-Type': content_type,
+            'stepchat-meta-size': str(file_size)
+        }
+        
+        # 发送上传请求
+        upload_url = 'https://chatglm.cn/chatglm/video-api/v1/static/upload'
+        response = self.api_request(
+            'POST', 
+            upload_url, 
+            data=body,
+            additional_headers=additional_headers,
+            retry_count=retry_count
+        )
+        
+        if not response:
             return None, None
+        
+        data = response.json()
+        if data["status"] == 0:
+            source_id = data["result"]["source_id"]
+            source_url = data["result"]["source_url"]
+            logger.info(f"[ZPHH] 图片上传成功: {source_id}")
+            return source_id, source_url
+        
+        logger.error(f"[ZPHH] 图片上传失败: {data}")
+        return None, None
 
     def _send_video_gen_request(self, prompt, source_id):
         """发送参考图视频生成请求"""
@@ -656,55 +2347,138 @@ class ZPHHPlugin(Plugin):
             logger.error(f"[ZPHH] 参考图视频任务创建失败: {data}")
             return None
             
+        except _Aborted:
+            raise
         except Exception as e:
             logger.error(f"[ZPHH] 创建参考图视频任务失败: {e}")
             return None
 
     def _check_video_status(self, task_id, max_retries=180):
         """改进的视频状态检查函数"""
+        if self._shared is not None:
+            return self._wait_shared_video(task_id, max_retries)
         try:
             for i in range(max_retries):
-                response = self.api_request(
-                    'GET',
-                    f"https://chatglm.cn/chatglm/video-api/v1/chat/status/{task_id}"
-                )
+                result = self._poll_video_once(task_id)
                 
-                if not response:
+                if not result:
                     if i % 12 == 0:  # 每分钟记录一次错误
                         logger.error(f"[ZPHH] 检查视频状态失败，将继续重试")
-                    time.sleep(5)
+                    self._sleep(5)
                     continue
                 
-                data = response.json()
-                if data["status"] == 0:
-                    result = data["result"]
-                    status = result.get("status")
-                    
-                    if status == "finished":
-                        video_url = result.get("video_url")
-                        if video_url:
-                            logger.info(f"[ZPHH] 视频生成成功: {video_url}")
-                            # 清理相关临时文件
-                            self._clean_video_temp_files(video_url)
-                            return video_url
-                    elif status == "failed":
-                        logger.error(f"[ZPHH] 视频生成失败: {result.get('msg')}")
-                        return None
-                    
-                    # 输出当前状态
-                    msg = result.get("msg", "处理中...")
-                    if i % 12 == 0:  # 每分钟输出一次日志
-                        logger.info(f"[ZPHH] 视频生成状态: {msg}")
+                status, video_url, msg = result
+                if status == "finished":
+                    logger.info(f"[ZPHH] 视频生成成功: {video_url}")
+                    # 清理相关临时文件
+                    self._clean_video_temp_files(video_url)
+                    return video_url
+                elif status == "failed":
+                    logger.error(f"[ZPHH] 视频生成失败: {msg}")
+                    return None
+                
+                # 输出当前状态
+                if i % 12 == 0:  # 每分钟输出一次日志
+                    logger.info(f"[ZPHH] 视频生成状态: {msg}")
                 
-                time.sleep(5)
+                self._sleep(5)
             
             logger.error("[ZPHH] 视频生成超时")
             return None
             
+        except _Aborted:
+            raise
         except Exception as e:
             logger.error(f"[ZPHH] 检查视频状态失败: {e}")
             return None
 
+    def _poll_video_once(self, task_id):
+        """查询一次视频状态，返回(状态, 视频URL, 消息)，请求失败时返回None"""
+        response = self.api_request(
+            'GET',
+            f"https://chatglm.cn/chatglm/video-api/v1/chat/status/{task_id}"
+        )
+        if not response:
+            return None
+        
+        data = response.json()
+        if data["status"] != 0:
+            return "pending", None, data.get("message", "")
+        
+        result = data["result"]
+        status = result.get("status")
+        if status == "finished" and result.get("video_url"):
+            return "finished", result["video_url"], result.get("msg")
+        if status == "failed":
+            return "failed", None, result.get("msg")
+        return "pending", None, result.get("msg", "处理中...")
+
+    def _wait_shared_video(self, task_id, max_retries):
+        """共享模式下登记视频任务，由持有轮询锁的进程统一轮询所有任务"""
+        with self._shared_poll_lock:
+            self._shared_waiters += 1
+        try:
+            self._shared.register_video(task_id)
+            for i in range(max_retries):
+                self._poll_shared_videos(max_age=max_retries * 5)
+                status, video_url, msg = self._shared.get_video(task_id)
+                if status == "finished":
+                    logger.info(f"[ZPHH] 视频生成成功: {video_url}")
+                    self._clean_video_temp_files(video_url)
+                    return video_url
+                elif status in ("failed", "timeout"):
+                    logger.error(f"[ZPHH] 视频生成失败: {msg or status}")
+                    return None
+                if i % 12 == 0:
+                    logger.info(f"[ZPHH] 视频生成中: {task_id}")
+                self._sleep(5)
+            
+            logger.error("[ZPHH] 视频生成超时")
+            return None
+            
+        except _Aborted:
+            # 不再等待结果，从登记表中移出，持有轮询锁的进程随即停止轮询该任务
+            try:
+                self._shared.finish_video(task_id, "cancelled")
+            except Exception as e:
+                logger.debug(f"[ZPHH] 标记视频任务取消失败: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"[ZPHH] 检查视频状态失败: {e}")
+            return None
+        finally:
+            with self._shared_poll_lock:
+                self._shared_waiters -= 1
+                # 本进程已没有等待中的任务，交出轮询锁让其他进程立即接管
+                if self._shared_waiters == 0:
+                    try:
+                        self._shared.release_lease("video_poller")
+                    except Exception as e:
+                        logger.debug(f"[ZPHH] 释放轮询锁失败: {e}")
+
+    def _poll_shared_videos(self, max_age):
+        """持有轮询锁时，对登记表中所有未完成的任务各查询一次"""
+        # 本进程内同一时刻只需一个线程轮询，且每5秒最多一轮
+        if not self._shared_poll_lock.acquire(blocking=False):
+            return
+        try:
+            if time.time() - self._last_shared_poll < 5 and not isinstance(self.session, _ReplaySession):
+                return
+            if not self._shared.try_lease("video_poller", 30):
+                return
+            self._last_shared_poll = time.time()
+            # 轮询的是所有进程登记的任务，不归属于当前任务：不带其请求ID、不受其截止时间和取消影响
+            job, self._local.job = self._current_job(), None
+            try:
+                for chat_id in self._shared.pending_videos(max_age):
+                    result = self._poll_video_once(chat_id)
+                    if result and result[0] != "pending":
+                        self._shared.finish_video(chat_id, *result)
+            finally:
+                self._local.job = job
+        finally:
+            self._shared_poll_lock.release()
+
     def _clean_video_temp_files(self, video_url):
         """清理视频相关的临时文件"""
         try:
@@ -725,7 +2499,57 @@ class ZPHHPlugin(Plugin):
             logger.error(f"[ZPHH] 清理视频临时文件失败: {e}")
 
     def refresh_access_token(self):
-        """刷新access token"""
+        """刷新access token，开启共享状态时同一主机只由一个进程刷新"""
+        if self._shared is None:
+            return self._refresh_access_token()
+        return self._refresh_shared_token(self.config.get('access_token'))
+
+    def _refresh_shared_token(self, stale_token):
+        """持有刷新锁的进程负责刷新，其他进程等待后直接采用共享的token"""
+        try:
+            deadline = time.time() + 30
+            while not self._shared.try_lease("token_refresh", 60):
+                if time.time() > deadline:
+                    logger.warning("[ZPHH] 等待其他进程刷新token超时")
+                    break
+                time.sleep(0.5)
+            else:
+                try:
+                    token, updated = self._shared.get_token()
+                    # 其他进程已经换过新token时直接采用，不再重复刷新
+                    if token and token != stale_token and time.time() - updated < 3600:
+                        self.config["access_token"] = token
+                        logger.info("[ZPHH] 采用其他进程刷新的access token")
+                        return True
+                    if not self._refresh_access_token():
+                        return False
+                    self._shared.set_token(self.config["access_token"])
+                    return True
+                finally:
+                    self._shared.release_lease("token_refresh")
+
+            token, _ = self._shared.get_token()
+            if token:
+                self.config["access_token"] = token
+            return bool(token)
+        except Exception as e:
+            logger.error(f"[ZPHH] 同步共享token失败: {e}")
+            return self._refresh_access_token()
+
+    def _sync_shared_token(self):
+        """定时检查共享token，过期时刷新，其他进程已刷新时同步到本进程"""
+        try:
+            token, updated = self._shared.get_token()
+            if not token or time.time() - updated >= 3600:
+                logger.info("[ZPHH] Refreshing access token...")
+                self._refresh_shared_token(token)
+            elif token != self.config.get('access_token'):
+                self.config["access_token"] = token
+        except Exception as e:
+            logger.error(f"[ZPHH] 同步共享token失败: {e}")
+
+    def _refresh_access_token(self):
+        """向服务器刷新access token"""
         try:
             refresh_token = self.config.get('refresh_token')
             if not refresh_token:
@@ -740,7 +2564,8 @@ class ZPHHPlugin(Plugin):
                 "https://chatglm.cn/chatglm/user-api/user/refresh",
                 json_data=json_data,
                 content_type="application/json;charset=UTF-8",
-                additional_headers={"Authorization": f"Bearer {refresh_token}"}
+                additional_headers={"Authorization": f"Bearer {refresh_token}"},
+                wait_token=False
             )
             
             if not response:
@@ -772,27 +2597,26 @@ class ZPHHPlugin(Plugin):
             # 解析参数
             prompt, video_style, emotional_atmosphere, mirror_mode, ratio = self._parse_video_params(params)
             
-            # 发送等待消息
-            e_context["reply"] = Reply(ReplyType.TEXT, "正在生成视频，请稍候...")
-            e_context["channel"].send(e_context["reply"], e_context["context"])
+            def run():
+                # 发送等待消息
+                e_context["channel"].send(Reply(ReplyType.TEXT, "正在生成视频，请稍候..."), e_context["context"])
+                return self._generate_text_video(prompt, video_style, emotional_atmosphere, mirror_mode, ratio)
             
-            # 发送视频生成请求
-            task_id = self._send_text_video_request(prompt, video_style, emotional_atmosphere, mirror_mode, ratio)
-            if not task_id:
-                e_context["reply"] = Reply(ReplyType.TEXT, "创建视频任务失败，请稍后重试")
-                e_context.action = EventAction.BREAK_PASS
-                return
+            def join():
+                e_context["channel"].send(Reply(ReplyType.TEXT, "相同的视频任务正在进行中，完成后将一并发送结果"), e_context["context"])
             
-            # 轮询检查视频生成状态
-            video_url = self._check_video_status(task_id)
+            # 参数完全相同的并发请求合并为一次上游调用
+            key = ("video", " ".join(prompt.split()), video_style, emotional_atmosphere, mirror_mode, ratio)
+            video_url, error = self._coalesce(key, run, join, e_context)
             if not video_url:
-                e_context["reply"] = Reply(ReplyType.TEXT, "获取视频结果失败，请稍后重试")
+                e_context["reply"] = Reply(ReplyType.TEXT, error)
                 e_context.action = EventAction.BREAK_PASS
                 return
             
             # 发送视频URL
             video_reply = Reply(ReplyType.VIDEO_URL, video_url)
-            e_context["channel"].send(video_reply, e_context["context"])
+            with self._span("deliver"):
+                e_context["channel"].send(video_reply, e_context["context"])
             
             # 发送成功消息
             params_info = []
@@ -808,11 +2632,24 @@ class ZPHHPlugin(Plugin):
             e_context["reply"] = Reply(ReplyType.TEXT, f"视频生成成功！\n使用参数：{params_text}")
             e_context.action = EventAction.BREAK_PASS
             
+        except (_Rejected, _Aborted) as e:
+            e_context["reply"] = Reply(ReplyType.TEXT, str(e))
+            e_context.action = EventAction.BREAK_PASS
         except Exception as e:
             logger.error(f"[ZPHH] 处理文生视频请求失败: {e}")
             e_context["reply"] = Reply(ReplyType.TEXT, f"处理文生视频请求失败: {str(e)}")
             e_context.action = EventAction.BREAK_PASS
 
+    def _generate_text_video(self, prompt, video_style, emotional_atmosphere, mirror_mode, ratio):
+        """创建文生视频任务并等待结果，返回(视频URL, 失败提示)"""
+        with self._span("create") as span:
+            task_id = self._send_text_video_request(prompt, video_style, emotional_atmosphere, mirror_mode, ratio)
+            if not task_id:
+                span["outcome"] = "failed"
+                return None, "创建视频任务失败，请稍后重试"
+        
+        return self._wait_video(task_id)
+
     def _parse_video_params(self, params):
         """解析视频参数"""
         # 默认参数
@@ -903,6 +2740,8 @@ class ZPHHPlugin(Plugin):
             logger.error(f"[ZPHH] 文生视频任务创建失败: {data}")
             return None
             
+        except _Aborted:
+            raise
         except Exception as e:
             logger.error(f"[ZPHH] 创建文生视频任务失败: {e}")
             return None